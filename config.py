@@ -33,11 +33,24 @@ class MQTTConfig:
     USERNAME = os.getenv('MQTT_USERNAME', None)
     PASSWORD = os.getenv('MQTT_PASSWORD', None)
     KEEPALIVE = int(os.getenv('MQTT_KEEPALIVE', 60))
+    # QoS 1/2 messages awaiting broker acknowledgement; also the publish window for file chunks
+    MAX_INFLIGHT = int(os.getenv('MQTT_MAX_INFLIGHT', 64))
     
     # Publisher settings
     PUBLISH_INTERVAL = int(os.getenv('PUBLISH_INTERVAL', 5))
+    # Messages per burst in the connection test; 1 keeps one message every PUBLISH_INTERVAL
+    PUBLISH_BATCH = int(os.getenv('PUBLISH_BATCH', 1))
     TOPIC_PREFIX = os.getenv('TOPIC_PREFIX', 'orca/iot')
     
+    # File transfer settings
+    HASH_WORKERS = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))
+    # File transfer chunk size when --chunk-size is not given; 0 probes the broker for one
+    CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 0))
+    # Max delay before coalesced subscriber state.json writes are flushed (0 = write through)
+    STATE_FLUSH_INTERVAL_MS = int(os.getenv('STATE_FLUSH_INTERVAL_MS', 500))
+    # Send QoS 0 chunk bodies with os.sendfile on plain TCP connections (Linux)
+    USE_SENDFILE = os.getenv('USE_SENDFILE', 'false').lower() in ('1', 'true', 'yes')
+    
     # QoS settings (0, 1, or 2)
     QOS = int(os.getenv('MQTT_QOS', os.getenv('QOS', 1)))
     
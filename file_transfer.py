@@ -1,26 +1,184 @@
 import os
-import json
+import binascii
 import time
 import uuid
 import hashlib
+import functools
 import mimetypes
 import logging
+import socket
+import ssl
+import struct
+import threading
+import paho.mqtt.client as mqtt
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Set
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+try:
+    import cbor2
+except ImportError:  # fall back to JSON control messages
+    cbor2 = None
 
 from config import MQTTConfig
+from json_codec import dumps, loads
 from mqtt_publisher import MQTTPublisher
 from mqtt_subscriber import MQTTSubscriber
 
 logger = logging.getLogger(__name__)
 
+# Seconds to wait on the oldest in-flight chunk before sending more
+PUBLISH_WINDOW_TIMEOUT = 5.0
+
+# Candidate chunk sizes timed by the broker probe when CHUNK_SIZE is 0, smallest first
+PROBE_CHUNK_SIZES = (64 * 1024, 256 * 1024, 1024 * 1024)
+# A larger candidate is only picked if it raises probed throughput by at least this factor
+PROBE_MIN_GAIN = 1.5
+
+# Binary chunk payload header: chunk_index (uint32) + chunk sha256 digest; file_id comes from the topic
+CHUNK_HEADER = struct.Struct("!I32s")
+
+
+# Load the mimetypes database once at import instead of on the first transfer
+mimetypes.init()
+
+
+class FileInfo(NamedTuple):
+    name: str
+    size: int
+
+
+def file_info(file_path: str) -> FileInfo:
+    return FileInfo(os.path.basename(file_path), os.path.getsize(file_path))
+
 
-def generate_file_id(file_path: str) -> str:
-    name = os.path.basename(file_path)
-    size = os.path.getsize(file_path)
+@functools.lru_cache(maxsize=1024)
+def guess_content_type(name: str) -> str:
+    content_type, _ = mimetypes.guess_type(name)
+    return content_type or "application/octet-stream"
+
+
+def generate_file_id(file_path: str, info: Optional[FileInfo] = None) -> str:
+    name, size = info or file_info(file_path)
     return f"{name}-{size}-{uuid.uuid4().hex[:8]}"
 
 
+def encode_control(msg: Dict) -> bytes:
+    """Encode a control message (meta/status/retry/ack): CBOR if available, else JSON with base64 for bytes."""
+    if cbor2 is not None:
+        return cbor2.dumps(msg)
+    return dumps(msg)
+
+
+def decode_control(payload: bytes) -> Dict:
+    """Decode a control message, sniffing JSON (always a '{' object) versus CBOR."""
+    if payload[:1] == b"{":
+        return loads(payload)
+    if cbor2 is None:
+        raise ValueError("CBOR control message received but cbor2 is not installed")
+    return cbor2.loads(payload)
+
+
+def _as_digest(value) -> bytes:
+    # CBOR carries raw digests; JSON carries them base64 (older senders and state files: hex)
+    if isinstance(value, bytes):
+        return value
+    if len(value) == 64:
+        return binascii.a2b_hex(value)
+    return binascii.a2b_base64(value)
+
+
+def _has_bit(bitmap: bytearray, idx: int) -> bool:
+    byte_index = idx >> 3
+    return byte_index < len(bitmap) and bool(bitmap[byte_index] & (1 << (idx & 7)))
+
+
+def _set_bit(bitmap: bytearray, idx: int):
+    byte_index = idx >> 3
+    if byte_index >= len(bitmap):
+        bitmap.extend(bytes(byte_index + 1 - len(bitmap)))
+    bitmap[byte_index] |= 1 << (idx & 7)
+
+
+def _clear_bit(bitmap: bytearray, idx: int):
+    byte_index = idx >> 3
+    if byte_index < len(bitmap):
+        bitmap[byte_index] &= ~(1 << (idx & 7)) & 0xFF
+
+
+def _missing_ranges(bitmap: bytearray, total: int, limit: int) -> List[List[int]]:
+    """Runs of unset bits below total as [start, length] pairs, at most limit of them.
+
+    Whole 64-bit words are tested at once so fully received (or fully missing) regions are skipped.
+    """
+    ranges: List[List[int]] = []
+    start = None
+    full = (1 << 64) - 1
+    for base in range(0, total, 64):
+        word = int.from_bytes(bitmap[base >> 3:(base >> 3) + 8], "little")
+        if word == 0:
+            if start is None:
+                start = base
+            continue
+        if word == full:
+            if start is not None:
+                ranges.append([start, base - start])
+                start = None
+                if len(ranges) >= limit:
+                    return ranges
+            continue
+        for idx in range(base, min(base + 64, total)):
+            if (word >> (idx - base)) & 1:
+                if start is not None:
+                    ranges.append([start, idx - start])
+                    start = None
+                    if len(ranges) >= limit:
+                        return ranges
+            elif start is None:
+                start = idx
+    if start is not None:
+        ranges.append([start, total - start])
+    return ranges[:limit]
+
+
+def _remaining_length(length: int) -> bytes:
+    """MQTT variable byte integer encoding of a packet's remaining length."""
+    out = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def _preallocate(fd: int, size: int):
+    """Reserve the final file size up front so positional chunk writes land in contiguous extents."""
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # e.g. filesystem without fallocate support
+    os.ftruncate(fd, size)
+
+
+def _sha256_digest(data: bytes) -> bytes:
+    # hashlib releases the GIL for large buffers, so this scales across pool threads
+    return hashlib.sha256(data).digest()
+
+
+def sha256_file(path: Path) -> str:
+    """Hex sha256 of a file, using hashlib.file_digest's buffer-reusing fast path when available."""
+    with open(path, "rb") as fp:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(fp, "sha256").hexdigest()
+        hasher = hashlib.sha256()
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            hasher.update(block)
+        return hasher.hexdigest()
+
+
 class FileTransferTopics:
     def __init__(self, prefix: str, file_id: str):
         self.base = f"{prefix}/file/{file_id}"
@@ -37,12 +195,15 @@ class ChunkedFilePublisher:
     def __init__(self, publisher: Optional[MQTTPublisher] = None, config: Optional[MQTTConfig] = None):
         self.config = config or MQTTConfig()
         self.publisher = publisher or MQTTPublisher(self.config)
+        # Chunk size picked by the first broker probe, reused for later transfers
+        self._probed_chunk_size: Optional[int] = None
 
-    def send_file(self, file_path: str, chunk_size: int = 256 * 1024, qos: Optional[int] = None) -> str:
+    def send_file(self, file_path: str, chunk_size: Optional[int] = None, qos: Optional[int] = None) -> str:
         if not os.path.isfile(file_path):
             raise FileNotFoundError(file_path)
 
-        file_id = generate_file_id(file_path)
+        info = file_info(file_path)
+        file_id = generate_file_id(file_path, info)
         topics = FileTransferTopics(self.config.TOPIC_PREFIX, file_id)
         qos = qos if qos is not None else self.config.QOS
 
@@ -50,58 +211,172 @@ class ChunkedFilePublisher:
         if not self.publisher.is_connected:
             if not self.publisher.connect():
                 raise RuntimeError("Failed to connect to broker")
+        chunk_size = chunk_size or self.config.CHUNK_SIZE or self._probe_chunk_size(info.size)
 
-        total_size = os.path.getsize(file_path)
+        total_size = info.size
         total_chunks = (total_size + chunk_size - 1) // chunk_size
 
-        # First pass: compute manifest (file hash and per-chunk hashes)
-        chunk_hashes: List[str] = []
-        file_hasher = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            while True:
-                data = f.read(chunk_size)
-                if not data:
-                    break
-                file_hasher.update(data)
-                chunk_hashes.append(hashlib.sha256(data).hexdigest())
-
-        content_type, _ = mimetypes.guess_type(file_path)
         manifest = {
             "schema": "orca.file.manifest.v1",
             "file_id": file_id,
-            "name": os.path.basename(file_path),
+            "name": info.name,
             "size": total_size,
             "chunk_size": chunk_size,
             "total_chunks": total_chunks,
-            "file_sha256": file_hasher.hexdigest(),
-            "chunk_sha256": chunk_hashes,
-            "content_type": content_type or "application/octet-stream",
+            "content_type": guess_content_type(info.name),
             "timestamp": int(time.time()),
         }
-        # Publish manifest before sending chunks
-        self.publisher.publish(topics.meta, manifest, qos)
+        # Publish the layout up front so the subscriber can place chunks as they arrive;
+        # hashes are only known after the read pass and follow in a trailing manifest
+        self.publisher.publish_bytes(topics.meta, encode_control(manifest), qos)
 
-        # Second pass: publish all chunks with their hash for convenience
+        file_hasher = hashlib.sha256()
         with open(file_path, "rb") as f:
-            index = 0
-            while True:
-                data = f.read(chunk_size)
-                if not data:
-                    break
-                payload = {
-                    "file_id": file_id,
-                    "chunk_index": index,
-                    "sha256": manifest["chunk_sha256"][index],
-                    "data": data.hex(),  # hex for safe JSON over MQTT
-                }
-                self.publisher.publish(topics.chunk, payload, qos)
-                index += 1
+            sock = self._sendfile_socket(qos)
+            if sock is not None:
+                chunk_hashes = self._send_chunks_sendfile(sock, f, topics.chunk, chunk_size, total_chunks, file_hasher)
+            else:
+                chunk_hashes = self._send_chunks(f, topics.chunk, chunk_size, total_chunks, file_hasher, qos)
+
+        # Trailing manifest completes the first one with file and per-chunk hashes
+        manifest["file_sha256"] = file_hasher.hexdigest()
+        manifest["chunk_sha256"] = chunk_hashes
+        self.publisher.publish_bytes(topics.meta, encode_control(manifest), qos)
 
         # Send status inquiry to encourage ACK or retry flow
-        self.publisher.publish(topics.status, {"request": "status"}, qos)
+        self.publisher.publish_bytes(topics.status, encode_control({"request": "status"}), qos)
 
         return file_id
 
+    def _send_chunks(self, f, chunk_topic: str, chunk_size: int, total_chunks: int, file_hasher, qos: int) -> List[bytes]:
+        """Single pass: per-chunk digests are computed on a thread pool while the file hash
+        is fed in order here; chunks are published in order as their digests complete."""
+        chunk_hashes: List[bytes] = []
+        workers = self.config.HASH_WORKERS
+        pending = deque()
+        # Sliding window of unacknowledged chunk publishes: bounds paho's queue without a wait per chunk
+        inflight = deque()
+        publish = self.publisher.publish_bytes
+        # Reusable read buffers, one per read-ahead slot; a slot is reused only after its chunk is published
+        slots = [memoryview(bytearray(chunk_size)) for _ in range(min(2 * workers, total_chunks))]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for index in range(total_chunks):
+                buf = slots[index % len(slots)]
+                data = buf[:f.readinto(buf)]
+                file_hasher.update(data)
+                pending.append((index, data, pool.submit(_sha256_digest, data)))
+                # Publish the oldest chunk before its buffer comes round again, and drain at the end
+                while pending and (len(pending) >= len(slots) or index == total_chunks - 1):
+                    chunk_index, chunk_data, future = pending.popleft()
+                    chunk_digest = future.result()
+                    chunk_hashes.append(chunk_digest)
+                    # MQTT payloads are binary-safe: raw bytes behind a fixed header, no hex/JSON.
+                    # The concatenation is the one copy per chunk; paho keeps it until sent.
+                    info = publish(chunk_topic, CHUNK_HEADER.pack(chunk_index, chunk_digest) + chunk_data, qos)
+                    inflight.append(info)
+                    if len(inflight) >= self.config.MAX_INFLIGHT:
+                        self._wait_published(inflight.popleft())
+        while inflight:
+            self._wait_published(inflight.popleft())
+        return chunk_hashes
+
+    def _sendfile_socket(self, qos: int) -> Optional[socket.socket]:
+        """The broker socket when the os.sendfile path applies: opted in, QoS 0, plain TCP."""
+        if not self.config.USE_SENDFILE or qos != 0 or not hasattr(os, "sendfile"):
+            return None
+        if self.publisher.shares_client:
+            # The sendfile path pauses paho's network thread, which other holders rely on
+            return None
+        sock = self.publisher.client.socket()
+        # TLS needs userspace encryption and websockets need framing; both use the paho path
+        if not isinstance(sock, socket.socket) or isinstance(sock, ssl.SSLSocket):
+            return None
+        return sock
+
+    def _send_chunks_sendfile(self, sock: socket.socket, f, chunk_topic: str, chunk_size: int, total_chunks: int, file_hasher) -> List[bytes]:
+        """Write QoS 0 PUBLISH frames directly, sending each chunk body from the file with os.sendfile.
+
+        The chunk is still read once to hash it (the digest goes in the header), but the body is
+        not copied back out of userspace. paho's network thread is paused so frames cannot interleave.
+        """
+        client = self.publisher.client
+        topic_bytes = chunk_topic.encode("utf-8")
+        variable_header = struct.pack("!H", len(topic_bytes)) + topic_bytes
+        if client._protocol == mqtt.MQTTv5:
+            variable_header += b"\x00"  # empty PUBLISH properties
+        chunk_hashes: List[bytes] = []
+        buf = memoryview(bytearray(chunk_size))
+        client.loop_stop()
+        sock.setblocking(True)
+        try:
+            # Flush anything paho still has queued (e.g. the manifest) ahead of our frames
+            while client.want_write():
+                rc = client.loop_write()
+                if rc != mqtt.MQTT_ERR_SUCCESS:
+                    raise RuntimeError(f"Failed to flush queued packets: {mqtt.error_string(rc)}")
+            for index in range(total_chunks):
+                data = buf[:f.readinto(buf)]
+                file_hasher.update(data)
+                chunk_digest = hashlib.sha256(data).digest()
+                chunk_hashes.append(chunk_digest)
+                remaining = len(variable_header) + CHUNK_HEADER.size + len(data)
+                sock.sendall(
+                    b"\x30" + _remaining_length(remaining) + variable_header + CHUNK_HEADER.pack(index, chunk_digest)
+                )
+                offset, end = index * chunk_size, index * chunk_size + len(data)
+                while offset < end:
+                    offset += os.sendfile(sock.fileno(), f.fileno(), offset, end - offset)
+        finally:
+            sock.setblocking(False)
+            client.loop_start()
+        return chunk_hashes
+
+    def _probe_chunk_size(self, file_size: int) -> int:
+        """Chunk size at the throughput knee, timed with one QoS 1 publish per PROBE_CHUNK_SIZES candidate.
+
+        Each probe is a zero-filled payload on {prefix}/probe/chunk, outside the transfer topics, and
+        is timed until its PUBACK. Probing stops at the first candidate that is not acknowledged
+        within PUBLISH_WINDOW_TIMEOUT (too slow, or over the broker's packet limit) or that gains
+        less than PROBE_MIN_GAIN in throughput. MQTT 3.1.1 brokers do not advertise their maximum
+        packet size, so this is the only way to learn it. Files that fit in the smallest candidate
+        are not probed.
+        """
+        if file_size <= PROBE_CHUNK_SIZES[0]:
+            return PROBE_CHUNK_SIZES[0]
+        if self._probed_chunk_size is not None:
+            return self._probed_chunk_size
+
+        topic = f"{self.config.TOPIC_PREFIX}/probe/chunk"
+        best, best_rate = PROBE_CHUNK_SIZES[0], 0.0
+        for size in PROBE_CHUNK_SIZES:
+            start = time.monotonic()
+            info = self.publisher.publish_bytes(topic, bytes(size), 1)
+            try:
+                info.wait_for_publish(PUBLISH_WINDOW_TIMEOUT)
+            except (ValueError, RuntimeError) as exc:
+                logger.warning(f"Chunk size probe of {size} bytes failed: {exc}")
+                break
+            if not info.is_published():
+                logger.warning(f"Chunk size probe of {size} bytes was not acknowledged")
+                break
+            rate = size / max(time.monotonic() - start, 1e-6)
+            if best_rate and rate < best_rate * PROBE_MIN_GAIN:
+                break
+            best, best_rate = size, rate
+        logger.info(f"Probed chunk size: {best} bytes")
+
+        # A broker that rejects an oversized packet may drop the connection; wait for the reconnect
+        if not self.publisher.is_connected and not self.publisher.connect():
+            raise RuntimeError("Lost the broker connection while probing the chunk size")
+        self._probed_chunk_size = best
+        return best
+
+    def _wait_published(self, info: mqtt.MQTTMessageInfo):
+        try:
+            info.wait_for_publish(PUBLISH_WINDOW_TIMEOUT)
+        except (ValueError, RuntimeError) as exc:
+            logger.error(f"Chunk publish failed (mid {info.mid}): {exc}")
+
 
 class ChunkedFileSubscriber:
     """Receives file chunks and reconstructs files with persistence and retry support."""
@@ -116,6 +391,20 @@ class ChunkedFileSubscriber:
         self.subscriber = subscriber or MQTTSubscriber(config=self.config)
         self.storage_root = Path(storage_dir)
         self.storage_root.mkdir(parents=True, exist_ok=True)
+        # In-memory state per file_id; "received" is a bitmap mirrored to received.bits on disk
+        self._state_cache: Dict[str, Dict] = {}
+        self._bitmap_fds: Dict[str, int] = {}
+        # Open data file descriptors per file_id for positional chunk writes
+        self._fd_cache: Dict[str, int] = {}
+        # Running full-file hash per file_id over the contiguous received prefix: [hasher, next_index]
+        self._file_hashers: Dict[str, List] = {}
+        # Header digests of chunks accepted before the trailing manifest, checked against it on arrival
+        self._chunk_digests: Dict[str, Dict[int, bytes]] = {}
+        self._topics: Dict[str, FileTransferTopics] = {}
+        # Coalesced state.json writes: file_ids with unsaved changes, flushed by a one-shot timer
+        self._dirty_states: Set[str] = set()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._flush_lock = threading.Lock()
 
         # Subscribe to all file topics under prefix
         topics = [f"{self.config.TOPIC_PREFIX}/file/+/+"]
@@ -128,6 +417,20 @@ class ChunkedFileSubscriber:
             raise RuntimeError("Subscriber failed to connect")
         self.subscriber.subscribe(self._subscribe_topics)
 
+    def stop(self):
+        try:
+            self.subscriber.disconnect()
+        finally:
+            self._flush_states()
+            for file_id in list(self._fd_cache) + list(self._bitmap_fds):
+                self._close_files(file_id)
+
+    def _topics_for(self, file_id: str) -> FileTransferTopics:
+        topics = self._topics.get(file_id)
+        if topics is None:
+            topics = self._topics[file_id] = FileTransferTopics(self.config.TOPIC_PREFIX, file_id)
+        return topics
+
     # State helpers
     def _state_dir(self, file_id: str) -> Path:
         d = self.storage_root / file_id
@@ -140,153 +443,315 @@ class ChunkedFileSubscriber:
     def _data_path(self, meta: Dict) -> Path:
         return self._state_dir(meta["file_id"]) / meta["name"]
 
+    def _bitmap_path(self, file_id: str) -> Path:
+        return self._state_dir(file_id) / "received.bits"
+
     def _load_state(self, file_id: str) -> Dict:
+        state = self._state_cache.get(file_id)
+        if state is not None:
+            return state
         p = self._state_path(file_id)
         if p.exists():
-            return json.loads(p.read_text())
-        return {
-            "file_id": file_id,
-            "name": None,
-            "size": None,
-            "chunk_size": None,
-            "total_chunks": None,
-            "file_sha256": None,
-            "chunk_sha256": None,
-            "received": [],
-            "complete": False,
-            "ack_sent": False,
-        }
-
-    def _save_state(self, state: Dict):
+            state = loads(p.read_bytes())
+            if state["chunk_sha256"]:
+                state["chunk_sha256"] = [_as_digest(h) for h in state["chunk_sha256"]]
+        else:
+            state = {
+                "file_id": file_id,
+                "name": None,
+                "size": None,
+                "chunk_size": None,
+                "total_chunks": None,
+                "file_sha256": None,
+                "chunk_sha256": None,
+                "complete": False,
+                "ack_sent": False,
+            }
+        # The bitmap is written per chunk and is authoritative for received indices after a restart
+        bits_path = self._bitmap_path(file_id)
+        bitmap = bytearray(bits_path.read_bytes()) if bits_path.exists() else bytearray()
+        # state.json files written before the bitmap existed carry a received list
+        for idx in state.pop("received", None) or []:
+            _set_bit(bitmap, idx)
+        state["received"] = bitmap
+        state["received_count"] = bin(int.from_bytes(bitmap, "little")).count("1")
+        self._state_cache[file_id] = state
+        return state
+
+    def _save_state(self, state: Dict, flush: bool = False):
+        """Persist state.json. Routine saves are coalesced and written within STATE_FLUSH_INTERVAL_MS;
+        flush=True (manifest, completion and ACK transitions) writes immediately."""
+        interval = self.config.STATE_FLUSH_INTERVAL_MS / 1000.0
+        with self._flush_lock:
+            if flush or interval <= 0:
+                self._dirty_states.discard(state["file_id"])
+                self._write_state(state)
+                return
+            self._dirty_states.add(state["file_id"])
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(interval, self._flush_states)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush_states(self):
+        with self._flush_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            for file_id in self._dirty_states:
+                self._write_state(self._state_cache[file_id])
+            self._dirty_states.clear()
+
+    def _write_state(self, state: Dict):
+        # Snapshot first: the timer thread may run while the MQTT thread updates the state
+        snapshot = dict(state)
+        persisted = {k: v for k, v in snapshot.items() if k not in ("received", "received_count")}
         p = self._state_path(state["file_id"])
-        p.write_text(json.dumps(state))
+        tmp = p.with_name(p.name + ".tmp")
+        tmp.write_bytes(dumps(persisted))
+        os.replace(tmp, p)  # atomic: a crash never leaves a truncated state.json
+
+    def _mark_received(self, state: Dict, idx: int):
+        """Record a chunk index in the bitmap and persist it with a single 1-byte write."""
+        _set_bit(state["received"], idx)
+        state["received_count"] += 1
+        byte_index = idx >> 3
+        os.pwrite(self._bitmap_fd(state["file_id"]), state["received"][byte_index:byte_index + 1], byte_index)
+
+    def _unmark_received(self, state: Dict, indices: Iterable[int]):
+        """Clear chunk indices from the bitmap and received.bits so they are requested again."""
+        bitmap = state["received"]
+        for idx in indices:
+            if _has_bit(bitmap, idx):
+                _clear_bit(bitmap, idx)
+                state["received_count"] -= 1
+        os.pwrite(self._bitmap_fd(state["file_id"]), bitmap, 0)
+        # The running hash may already cover cleared chunks; it is rebuilt from disk on the next chunk
+        self._file_hashers.pop(state["file_id"], None)
+
+    def _bitmap_fd(self, file_id: str) -> int:
+        fd = self._bitmap_fds.get(file_id)
+        if fd is None:
+            fd = os.open(self._bitmap_path(file_id), os.O_RDWR | os.O_CREAT, 0o644)
+            self._bitmap_fds[file_id] = fd
+        return fd
+
+    def _data_fd(self, state: Dict) -> int:
+        """Return the cached fd for a file's data, opening it on first use."""
+        file_id = state["file_id"]
+        fd = self._fd_cache.get(file_id)
+        if fd is None:
+            data_path = self._data_path({"file_id": file_id, "name": state["name"] or f"{file_id}.bin"})
+            fd = os.open(data_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._fd_cache[file_id] = fd
+        return fd
+
+    def _close_files(self, file_id: str):
+        self._file_hashers.pop(file_id, None)
+        self._chunk_digests.pop(file_id, None)
+        for cache in (self._fd_cache, self._bitmap_fds):
+            fd = cache.pop(file_id, None)
+            if fd is not None:
+                os.close(fd)
 
     # MQTT handlers
     def _on_message(self, topic: str, payload: bytes):
-        try:
-            text = payload.decode("utf-8")
-            data = json.loads(text)
-        except Exception:
-            logger.warning("Non-JSON payload on file topic; ignored")
-            return
-
         parts = topic.split("/")
         # .../{prefix}/file/{file_id}/{kind}
         kind = parts[-1]
         file_id = parts[-2]
 
+        if kind == "chunk":
+            # Chunks are binary; skip JSON decoding entirely
+            self._handle_chunk(file_id, payload)
+            return
+
+        try:
+            data = decode_control(payload)
+        except Exception:
+            logger.warning("Undecodable control payload on file topic; ignored")
+            return
+
         if kind == "meta":
             self._handle_meta(data)
-        elif kind == "chunk":
-            self._handle_chunk(data)
-        elif kind == "status":
-            # Publisher asked for status → emit status
+        elif kind == "status" and data.get("request") == "status":
+            # Publisher asked for status → emit status (our own status reports echo back here too)
             self._emit_status(file_id)
 
     def _handle_meta(self, meta: Dict):
         state = self._load_state(meta["file_id"])
+        if state["complete"]:
+            # Already verified and its files closed; a re-sent manifest must not reopen them
+            self._emit_status(meta["file_id"])
+            return
         state.update({
             "name": meta["name"],
             "size": meta["size"],
             "chunk_size": meta["chunk_size"],
             "total_chunks": meta["total_chunks"],
-            "file_sha256": meta.get("file_sha256"),
-            "chunk_sha256": meta.get("chunk_sha256"),
         })
-        self._save_state(state)
+        # Hashes only arrive with the trailing manifest; never clear them on a re-sent header
+        if meta.get("file_sha256"):
+            state["file_sha256"] = meta["file_sha256"]
+        verify = False
+        if meta.get("chunk_sha256"):
+            verify = not state["chunk_sha256"]
+            state["chunk_sha256"] = [_as_digest(h) for h in meta["chunk_sha256"]]
+        # Written now, not coalesced: chunk bits hit received.bits immediately and are useless
+        # after a crash without the layout they index into
+        self._save_state(state, flush=True)
+        _preallocate(self._data_fd(state), state["size"])
+        if verify:
+            self._verify_received_chunks(state)
+        if state["file_sha256"] and not state["complete"]:
+            # Chunks may all be in already, waiting on the trailing manifest
+            self._check_complete(state)
+            if state["complete"]:
+                return
         # On new meta, emit status so publisher can retry missing chunks
         self._emit_status(meta["file_id"])
 
-    def _handle_chunk(self, chunk: Dict):
-        file_id = chunk["file_id"]
-        idx = int(chunk["chunk_index"])
-        blob = bytes.fromhex(chunk["data"]) if isinstance(chunk["data"], str) else chunk["data"]
+    def _handle_chunk(self, file_id: str, payload: bytes):
+        if len(payload) < CHUNK_HEADER.size:
+            logger.warning(f"Truncated chunk payload for {file_id}; ignored")
+            return
+        idx, chunk_digest = CHUNK_HEADER.unpack_from(payload)
+        blob = memoryview(payload)[CHUNK_HEADER.size:]
 
         state = self._load_state(file_id)
-        # Ensure meta received; if not, buffer state minimal
-        if state["chunk_size"] is None:
-            # Accept but we can't place correctly without chunk_size; still write sequential if possible
-            pass
+        total = state["total_chunks"]
+        if total is None:
+            # Without the manifest's layout the write offset would be a guess that can land on other
+            # chunks; status requests the chunk again once the manifest is in
+            logger.warning(f"Chunk {idx} for {file_id} arrived before its manifest; ignored")
+            return
+        if idx >= total:
+            logger.warning(f"Chunk index {idx} out of range for {file_id} ({total} chunks); ignored")
+            return
+        if _has_bit(state["received"], idx):
+            # Already verified and on disk; a resend must not overwrite it
+            return
 
-        # Append or positionally write
-        data_path = self._data_path({"file_id": file_id, "name": state.get("name", f"{file_id}.bin")})
+        # Chunk hash verification: manifest hash if the trailing manifest is in, else the chunk's own
+        expected_chunk_hashes = state.get("chunk_sha256")
+        from_manifest = bool(expected_chunk_hashes) and idx < len(expected_chunk_hashes)
+        expected = expected_chunk_hashes[idx] if from_manifest else chunk_digest
+        if hashlib.sha256(blob).digest() != expected:
+            logger.warning(f"Chunk hash mismatch for {file_id} chunk {idx}")
+            # Do not write or mark as received; request retry
+            self._emit_status(file_id)
+            return
 
-        # Ensure file exists
-        if not data_path.exists():
-            data_path.write_bytes(b"")
+        if not from_manifest:
+            self._chunk_digests.setdefault(file_id, {})[idx] = chunk_digest
 
-        with open(data_path, "r+b") as fp:
-            fp.seek(idx * (state["chunk_size"] or len(blob)))
-            fp.write(blob)
+        # Single positional write straight from the inbound payload buffer
+        os.pwrite(self._data_fd(state), blob, idx * state["chunk_size"])
+        self._mark_received(state, idx)
+        self._advance_file_hash(state, idx, blob)
 
-        # Chunk hash verification if present
-        expected_chunk_hashes = state.get("chunk_sha256")
-        if expected_chunk_hashes and idx < len(expected_chunk_hashes):
-            actual = hashlib.sha256(blob).hexdigest()
-            expected = expected_chunk_hashes[idx]
-            if expected and actual != expected:
-                logger.warning(f"Chunk hash mismatch for {file_id} chunk {idx}")
-                # Do not mark as received; request retry
+        self._check_complete(state)
+        if not state["complete"]:
+            # periodically emit status for backpressure/flow control
+            if state["received_count"] % 50 == 0:
                 self._emit_status(file_id)
-                return
 
-        if idx not in state["received"]:
-            state["received"].append(idx)
-        self._save_state(state)
-
-        # Completion check
+    def _verify_received_chunks(self, state: Dict):
+        """Check chunks accepted on their own header digest against the trailing manifest's hashes."""
+        file_id = state["file_id"]
+        accepted = self._chunk_digests.pop(file_id, {})
+        expected = state["chunk_sha256"]
+        chunk_size, size = state["chunk_size"], state["size"]
+        bad = []
+        for idx in range(min(state["total_chunks"], len(expected))):
+            if not _has_bit(state["received"], idx):
+                continue
+            digest = accepted.get(idx)
+            if digest is None:
+                # Accepted before a restart: only the data on disk is left to check
+                offset = idx * chunk_size
+                digest = hashlib.sha256(os.pread(self._data_fd(state), min(chunk_size, size - offset), offset)).digest()
+            if digest != expected[idx]:
+                bad.append(idx)
+        if bad:
+            logger.warning(f"{len(bad)} chunks of {file_id} do not match the manifest; requesting them again")
+            self._unmark_received(state, bad)
+
+    def _advance_file_hash(self, state: Dict, idx: int, blob: memoryview):
+        """Extend the running file hash over the contiguous prefix of received chunks."""
+        file_id = state["file_id"]
+        running = self._file_hashers.setdefault(file_id, [hashlib.sha256(), 0])
+        hasher, next_idx = running
+        if idx == next_idx:
+            hasher.update(blob)
+            next_idx += 1
+        chunk_size = state["chunk_size"]
+        if chunk_size:
+            # Chunks that arrived ahead of order (or before a restart) are already on disk
+            fd = self._data_fd(state)
+            while _has_bit(state["received"], next_idx):
+                hasher.update(os.pread(fd, chunk_size, next_idx * chunk_size))
+                next_idx += 1
+        running[1] = next_idx
+
+    def _check_complete(self, state: Dict):
+        """Verify the full file hash and ACK once every chunk and the trailing manifest are in."""
+        file_id = state["file_id"]
         total = state.get("total_chunks")
-        if total is not None and len(state["received"]) >= total and not state["complete"]:
-            state["complete"] = True
-            self._save_state(state)
-            # Validate full file hash before ACK
-            try:
-                data_path = self._data_path({"file_id": file_id, "name": state.get("name", f"{file_id}.bin")})
-                hasher = hashlib.sha256()
-                with open(data_path, "rb") as fp:
-                    for chunk_data in iter(lambda: fp.read(state["chunk_size"] or 1024 * 1024), b""):
-                        hasher.update(chunk_data)
-                actual_file_hash = hasher.hexdigest()
-                expected_file_hash = state.get("file_sha256")
-                if expected_file_hash and actual_file_hash != expected_file_hash:
-                    logger.warning(f"File hash mismatch for {file_id}; requesting retry of all chunks")
-                    # Reset completion and request retry (missing will be computed as any chunk not in received)
-                    state["complete"] = False
-                    self._save_state(state)
-                    self._emit_status(file_id)
-                else:
-                    self._emit_ack(file_id)
-            except Exception as exc:
-                logger.error(f"Error verifying full file hash for {file_id}: {exc}")
-                self._emit_status(file_id)
-        else:
-            # periodically emit status for backpressure/flow control
-            if len(state["received"]) % 50 == 0:
+        if total is None or state["received_count"] < total or state["complete"]:
+            return
+        expected_file_hash = state.get("file_sha256")
+        if not expected_file_hash:
+            # All chunks in, but the trailing manifest with the file hash has not arrived yet
+            return
+        state["complete"] = True
+        self._save_state(state, flush=True)
+        # Validate full file hash before ACK
+        try:
+            running = self._file_hashers.pop(file_id, None)
+            if running is not None and running[1] == total:
+                actual_file_hash = running[0].hexdigest()
+            else:
+                # Running hash never covered the whole file; fall back to re-reading it
+                data_path = self._data_path({"file_id": file_id, "name": state["name"] or f"{file_id}.bin"})
+                actual_file_hash = sha256_file(data_path)
+            if actual_file_hash != expected_file_hash:
+                logger.warning(f"File hash mismatch for {file_id}; requesting retry of all chunks")
+                # No way to tell which chunk is bad: forget them all so status asks for every one
+                # and resends are accepted again
+                state["complete"] = False
+                self._unmark_received(state, range(total))
+                self._save_state(state, flush=True)
                 self._emit_status(file_id)
+            else:
+                self._emit_ack(file_id)
+        except Exception as exc:
+            logger.error(f"Error verifying full file hash for {file_id}: {exc}")
+            self._emit_status(file_id)
 
     def _emit_status(self, file_id: str):
-        topics = FileTransferTopics(self.config.TOPIC_PREFIX, file_id)
+        topics = self._topics_for(file_id)
         state = self._load_state(file_id)
         total = state.get("total_chunks")
-        missing: List[int] = []
+        missing: List[List[int]] = []
         if total is not None:
-            have = set(state["received"]) if state["received"] else set()
-            missing = [i for i in range(total) if i not in have]
+            # [start, length] runs, capped per message
+            missing = _missing_ranges(state["received"], total, 500)
         payload = {
             "file_id": file_id,
-            "received": len(state.get("received", [])),
+            "received": state["received_count"],
             "total": total,
-            "missing": missing[:500],  # cap list size per message
+            "missing_ranges": missing,
             "complete": state.get("complete", False),
         }
         # Send status, and if missing exists, also send a retry request
-        self.subscriber.client.publish(topics.status, json.dumps(payload), self.config.QOS)
+        self.subscriber.client.publish(topics.status, encode_control(payload), self.config.QOS)
         if missing:
-            retry = {"file_id": file_id, "missing": missing[:500]}
-            self.subscriber.client.publish(topics.retry, json.dumps(retry), self.config.QOS)
+            retry = {"file_id": file_id, "missing_ranges": missing}
+            self.subscriber.client.publish(topics.retry, encode_control(retry), self.config.QOS)
 
     def _emit_ack(self, file_id: str):
-        topics = FileTransferTopics(self.config.TOPIC_PREFIX, file_id)
+        topics = self._topics_for(file_id)
         state = self._load_state(file_id)
         if state.get("ack_sent"):
             return
@@ -295,8 +760,9 @@ class ChunkedFileSubscriber:
             "status": "ok",
             "timestamp": int(time.time()),
         }
-        self.subscriber.client.publish(topics.ack, json.dumps(ack), self.config.QOS)
+        self.subscriber.client.publish(topics.ack, encode_control(ack), self.config.QOS)
         state["ack_sent"] = True
-        self._save_state(state)
+        self._save_state(state, flush=True)
+        self._close_files(file_id)
 
 
@@ -0,0 +1,27 @@
+import json
+import binascii
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # stdlib json fallback
+    orjson = None
+
+
+def _default(obj):
+    # bytes (e.g. chunk digests) go out base64, matching how the file-transfer receiver reads them
+    if isinstance(obj, (bytes, bytearray)):
+        return binascii.b2a_base64(obj, newline=False).decode("ascii")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize to UTF-8 JSON bytes, with orjson when installed"""
+    if orjson is not None:
+        # Non-str keys are stringified, as the stdlib json module does
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default).encode("utf-8")
+
+
+# Both accept bytes directly, so payloads are never decoded to str first
+loads = orjson.loads if orjson is not None else json.loads
@@ -0,0 +1,122 @@
+import threading
+import weakref
+from typing import Callable, Dict, List, Tuple
+import paho.mqtt.client as mqtt
+from config import MQTTConfig
+
+
+class SharedMQTTLoop:
+    """One paho client and network thread per (broker, port, client_id), shared by reference count.
+
+    MQTTPublisher and MQTTSubscriber instances in the same process that use the same client ID
+    share a single connection (the broker would otherwise disconnect one of them), one network
+    thread and one socket. Holders take a reference with acquire() when they connect and drop it
+    with release() when they disconnect; callbacks are fanned out to every connected holder and
+    the connection is closed when the last one releases. The registry only keeps entries alive
+    while some holder references them.
+    """
+
+    _registry: "weakref.WeakValueDictionary[Tuple[str, int, str], SharedMQTTLoop]" = weakref.WeakValueDictionary()
+    _registry_lock = threading.Lock()
+
+    def __init__(self, key: Tuple[str, int, str], config: MQTTConfig):
+        self.key = key
+        self.config = config
+        self.settings = self._settings(config)
+        self.client = mqtt.Client(client_id=key[2], clean_session=config.CLEAN_SESSION)
+        self._refs = 0
+        self._started = False
+        self._lock = threading.Lock()
+        self._handlers: Dict[str, List[Callable]] = {}
+
+        # Set authentication if provided
+        if config.USERNAME and config.PASSWORD:
+            self.client.username_pw_set(config.USERNAME, config.PASSWORD)
+
+        # Enable automatic reconnection
+        if config.AUTO_RECONNECT:
+            self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+
+        # Allow a full publish window in flight (paho defaults to 20); outbound queue stays unbounded
+        self.client.max_inflight_messages_set(config.MAX_INFLIGHT)
+
+    @classmethod
+    def get(cls, config: MQTTConfig, client_id: str) -> "SharedMQTTLoop":
+        """Return the shared loop for this broker and client ID, creating it on first use.
+
+        Raises ValueError if the loop exists with different connection settings: one client ID is
+        one broker session, so holders cannot each bring their own credentials or session options.
+        """
+        key = (config.BROKER_HOST, config.BROKER_PORT, client_id)
+        with cls._registry_lock:
+            loop = cls._registry.get(key)
+            if loop is None:
+                loop = cls(key, config)
+                cls._registry[key] = loop
+            elif loop.settings != cls._settings(config):
+                raise ValueError(f"Client ID {client_id!r} is already in use with different connection settings")
+            return loop
+
+    @staticmethod
+    def _settings(config: MQTTConfig) -> Tuple:
+        # Everything the shared client is built with besides the registry key
+        return (config.USERNAME, config.PASSWORD, config.CLEAN_SESSION, config.KEEPALIVE,
+                config.AUTO_RECONNECT, config.MAX_INFLIGHT)
+
+    @property
+    def shared(self) -> bool:
+        """True while more than one holder is connected through this client."""
+        return self._refs > 1
+
+    def acquire(self, **callbacks: Callable) -> bool:
+        """Take a reference and register the holder's paho callbacks by name (on_connect=...).
+
+        Connects and starts the network thread for the first holder; returns False if another
+        holder already had, in which case no on_connect will follow for this one.
+        """
+        with self._lock:
+            self._add_callbacks(callbacks)
+            self._refs += 1
+            if self._started:
+                return False
+            try:
+                self.client.connect(self.config.BROKER_HOST, self.config.BROKER_PORT, self.config.KEEPALIVE)
+            except Exception:
+                self._refs -= 1
+                self._remove_callbacks(callbacks)
+                raise
+            self.client.loop_start()
+            self._started = True
+            return True
+
+    def release(self, **callbacks: Callable):
+        """Drop one reference and the holder's callbacks; disconnect when none remain."""
+        with self._lock:
+            self._remove_callbacks(callbacks)
+            self._refs -= 1
+            if self._refs > 0 or not self._started:
+                return
+            self.client.loop_stop()
+            self.client.disconnect()
+            self._started = False
+
+    def _add_callbacks(self, callbacks: Dict[str, Callable]):
+        for name, callback in callbacks.items():
+            self._handlers.setdefault(name, []).append(callback)
+            if getattr(self.client, name) is None:
+                setattr(self.client, name, self._fan_out(name))
+
+    def _remove_callbacks(self, callbacks: Dict[str, Callable]):
+        for name, callback in callbacks.items():
+            handlers = self._handlers.get(name, [])
+            if callback in handlers:
+                handlers.remove(callback)
+
+    def _fan_out(self, name: str) -> Callable:
+        handlers = self._handlers[name]
+
+        def dispatch(*args):
+            for callback in list(handlers):
+                callback(*args)
+
+        return dispatch
@@ -1,9 +1,11 @@
-import json
+import copy
 import time
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional
 import paho.mqtt.client as mqtt
 from config import MQTTConfig
+from json_codec import dumps
+from mqtt_loop import SharedMQTTLoop
 
 # Configure logging
 logging.basicConfig(
@@ -12,6 +14,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Log a publish summary at INFO every N messages instead of one line per message
+PUBLISH_LOG_EVERY = 500
+
 
 class MQTTPublisher:
     """MQTT Publisher for IoT device simulation"""
@@ -20,32 +25,42 @@ class MQTTPublisher:
         """Initialize MQTT Publisher"""
         self.config = config or MQTTConfig()
         self.client = None
+        self._loop: Optional[SharedMQTTLoop] = None
+        self._holding_loop = False
         self.is_connected = False
         self.message_count = 0
+        # Helper topic prefixes, built once (paho 1.6 encodes str topics itself, so these stay str)
+        self._sensor_prefix = f"{self.config.TOPIC_PREFIX}/sensor/"
+        self._device_prefix = f"{self.config.TOPIC_PREFIX}/device/"
+        self._alerts_prefix = f"{self.config.TOPIC_PREFIX}/alerts/"
         
         # Setup MQTT client
         self._setup_client()
     
     def _setup_client(self):
-        """Setup MQTT client with callbacks"""
-        self.client = mqtt.Client(
-            client_id=self.config.CLIENT_ID,
-            clean_session=self.config.CLEAN_SESSION
-        )
-        
-        # Set callbacks
-        self.client.on_connect = self._on_connect
-        self.client.on_disconnect = self._on_disconnect
-        self.client.on_publish = self._on_publish
-        self.client.on_log = self._on_log
-        
-        # Set authentication if provided
-        if self.config.USERNAME and self.config.PASSWORD:
-            self.client.username_pw_set(self.config.USERNAME, self.config.PASSWORD)
-        
-        # Enable automatic reconnection
-        if self.config.AUTO_RECONNECT:
-            self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+        """Look up the shared MQTT client for this broker and client ID"""
+        # Per-message debug callbacks cost a Python call each; only wire them when DEBUG is on
+        self._debug_callbacks = logger.isEnabledFor(logging.DEBUG)
+        
+        # Callbacks are registered (and a reference taken) only while connected
+        self._loop = SharedMQTTLoop.get(self.config, self.config.CLIENT_ID)
+        self.client = self._loop.client
+    
+    def _callbacks(self) -> Dict[str, Callable]:
+        # Built per call rather than stored, so an unconnected publisher holds no reference cycle
+        callbacks = {
+            "on_connect": self._on_connect,
+            "on_disconnect": self._on_disconnect,
+        }
+        if self._debug_callbacks:
+            callbacks["on_publish"] = self._on_publish
+            callbacks["on_log"] = self._on_log
+        return callbacks
+    
+    @property
+    def shares_client(self) -> bool:
+        """True while another publisher/subscriber is connected through the same paho client"""
+        return self._loop.shared
     
     def _on_connect(self, client, userdata, flags, rc):
         """Callback when connected to MQTT broker"""
@@ -76,20 +91,18 @@ class MQTTPublisher:
         """Connect to MQTT broker"""
         try:
             logger.info(f"Connecting to MQTT broker at {self.config.BROKER_HOST}:{self.config.BROKER_PORT}")
-            self.client.connect(
-                self.config.BROKER_HOST,
-                self.config.BROKER_PORT,
-                self.config.KEEPALIVE
-            )
-            
-            # Start the loop in a non-blocking way
-            self.client.loop_start()
+            if not self._holding_loop:
+                # Connects and starts the network thread unless another holder already did
+                self._loop.acquire(**self._callbacks())
+                self._holding_loop = True
             
-            # Wait for connection
+            # Wait for connection (a shared client may already be connected)
             timeout = 10
             start_time = time.time()
             while not self.is_connected and (time.time() - start_time) < timeout:
-                time.sleep(0.1)
+                self.is_connected = self.client.is_connected()
+                if not self.is_connected:
+                    time.sleep(0.1)
             
             return self.is_connected
             
@@ -99,25 +112,82 @@ class MQTTPublisher:
     
     def disconnect(self):
         """Disconnect from MQTT broker"""
-        if self.client:
-            self.client.loop_stop()
-            self.client.disconnect()
+        if self._holding_loop:
+            self._loop.release(**self._callbacks())
+            self._holding_loop = False
             self.is_connected = False
             logger.info("Disconnected from MQTT broker")
     
     def publish(self, topic: str, payload: Any, qos: int = None) -> bool:
         """Publish message to MQTT topic"""
+        # Convert payload to JSON if it's a dict
+        if isinstance(payload, dict):
+            return self.publish_json(topic, payload, qos)
+        elif not isinstance(payload, (str, bytes)):
+            payload = str(payload)
+        return self._send(topic, payload, qos)
+    
+    def publish_json(self, topic: str, obj: Dict[str, Any], qos: int = None) -> bool:
+        """Publish a dict as JSON, skipping publish()'s payload type dispatch"""
+        try:
+            payload = dumps(obj)
+        except (TypeError, ValueError) as e:
+            logger.error("Error publishing message: %s", e)
+            return False
+        return self._send(topic, payload, qos)
+    
+    def publish_bytes(self, topic: str, data: bytes, qos: int = None) -> mqtt.MQTTMessageInfo:
+        """Publish an already-encoded payload with no checks or logging (hot path).
+        
+        Returns paho's MQTTMessageInfo so callers can track delivery; while disconnected,
+        paho keeps QoS 1/2 messages queued for the reconnect.
+        """
+        info = self.client.publish(topic, data, self.config.QOS if qos is None else qos)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.message_count += 1
+        return info
+    
+    def publish_batch(self, topic: str, payloads: Iterable[Any], qos: int = None) -> List[mqtt.MQTTMessageInfo]:
+        """Publish several payloads to one topic in a burst; returns the queued messages' info.
+        
+        Dicts are serialized up front, then all messages are handed to paho back to back so the
+        network thread flushes them together instead of waking once per message.
+        """
+        if not self.is_connected:
+            logger.error("Not connected to MQTT broker")
+            return []
+        
+        try:
+            encoded = [dumps(p) if isinstance(p, dict) else p if isinstance(p, (str, bytes)) else str(p)
+                       for p in payloads]
+        except (TypeError, ValueError) as e:
+            logger.error("Error publishing message: %s", e)
+            return []
+        
+        qos = qos if qos is not None else self.config.QOS
+        publish = self.client.publish
+        infos: List[mqtt.MQTTMessageInfo] = []
+        for payload in encoded:
+            result = publish(topic, payload, qos)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error("Failed to publish message. Return code: %s", result.rc)
+                break
+            infos.append(result)
+        
+        sent = len(infos)
+        before = self.message_count
+        self.message_count += sent
+        logger.debug("Published batch of %d messages to topic: %s", sent, topic)
+        if self.message_count // PUBLISH_LOG_EVERY != before // PUBLISH_LOG_EVERY:
+            logger.info("Published %d messages (last topic: %s)", self.message_count, topic)
+        return infos
+    
+    def _send(self, topic: str, payload: Any, qos: int = None) -> bool:
         if not self.is_connected:
             logger.error("Not connected to MQTT broker")
             return False
         
         try:
-            # Convert payload to JSON if it's a dict
-            if isinstance(payload, dict):
-                payload = json.dumps(payload)
-            elif not isinstance(payload, (str, bytes)):
-                payload = str(payload)
-            
             # Use config QoS if not specified
             qos = qos if qos is not None else self.config.QOS
             
@@ -126,19 +196,21 @@ class MQTTPublisher:
             
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
                 self.message_count += 1
-                logger.info(f"Published message #{self.message_count} to topic: {topic}")
+                logger.debug("Published message #%d to topic: %s", self.message_count, topic)
+                if self.message_count % PUBLISH_LOG_EVERY == 0:
+                    logger.info("Published %d messages (last topic: %s)", self.message_count, topic)
                 return True
             else:
-                logger.error(f"Failed to publish message. Return code: {result.rc}")
+                logger.error("Failed to publish message. Return code: %s", result.rc)
                 return False
                 
         except Exception as e:
-            logger.error(f"Error publishing message: {e}")
+            logger.error("Error publishing message: %s", e)
             return False
     
     def publish_sensor_data(self, sensor_id: str, data: Dict[str, Any], qos: int = None) -> bool:
         """Publish sensor data to MQTT topic"""
-        topic = f"{self.config.TOPIC_PREFIX}/sensor/{sensor_id}"
+        topic = self._sensor_prefix + sensor_id
         
         # Add timestamp to data
         message = {
@@ -151,7 +223,7 @@ class MQTTPublisher:
     
     def publish_device_status(self, device_id: str, status: str, metadata: Dict[str, Any] = None, qos: int = None) -> bool:
         """Publish device status to MQTT topic"""
-        topic = f"{self.config.TOPIC_PREFIX}/device/{device_id}/status"
+        topic = self._device_prefix + device_id + "/status"
         
         message = {
             "timestamp": int(time.time()),
@@ -166,7 +238,7 @@ class MQTTPublisher:
     
     def publish_alert(self, alert_type: str, message: str, severity: str = "info", metadata: Dict[str, Any] = None, qos: int = None) -> bool:
         """Publish alert to MQTT topic"""
-        topic = f"{self.config.TOPIC_PREFIX}/alerts/{alert_type}"
+        topic = self._alerts_prefix + alert_type
         
         alert_message = {
             "timestamp": int(time.time()),
@@ -189,3 +261,54 @@ class MQTTPublisher:
             "broker_port": self.config.BROKER_PORT,
             "client_id": self.config.CLIENT_ID
         }
+
+
+class MQTTPublisherPool:
+    """Round-robin pool of MQTTPublisher connections, each with its own client ID and socket"""
+    
+    def __init__(self, size: int = 4, config: MQTTConfig = None):
+        """Create size publishers with CLIENT_ID suffixes _0.._{size-1}"""
+        self.config = config or MQTTConfig()
+        self.publishers: List[MQTTPublisher] = []
+        for i in range(max(1, size)):
+            member_config = copy.copy(self.config)
+            member_config.CLIENT_ID = f"{self.config.CLIENT_ID}_{i}"
+            self.publishers.append(MQTTPublisher(member_config))
+        self._rr = 0
+    
+    def _next(self) -> MQTTPublisher:
+        publisher = self.publishers[self._rr]
+        self._rr = (self._rr + 1) % len(self.publishers)
+        return publisher
+    
+    @property
+    def is_connected(self) -> bool:
+        return all(p.is_connected for p in self.publishers)
+    
+    def connect(self) -> bool:
+        """Connect every publisher in the pool"""
+        return all([p.connect() for p in self.publishers])
+    
+    def disconnect(self):
+        """Disconnect every publisher in the pool"""
+        for p in self.publishers:
+            p.disconnect()
+    
+    def publish(self, topic: str, payload: Any, qos: int = None) -> bool:
+        """Publish through the next connection in turn"""
+        return self._next().publish(topic, payload, qos)
+    
+    def publish_batch(self, topic: str, payloads: Iterable[Any], qos: int = None) -> List[mqtt.MQTTMessageInfo]:
+        """Publish a whole batch through the next connection in turn"""
+        return self._next().publish_batch(topic, payloads, qos)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get pool statistics, with per-connection stats under publishers"""
+        members = [p.get_stats() for p in self.publishers]
+        return {
+            "connected": self.is_connected,
+            "message_count": sum(m["message_count"] for m in members),
+            "broker_host": self.config.BROKER_HOST,
+            "broker_port": self.config.BROKER_PORT,
+            "publishers": members
+        }
@@ -1,9 +1,10 @@
 import json
 import time
 import logging
-from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 import paho.mqtt.client as mqtt
 from config import MQTTConfig
+from mqtt_loop import SharedMQTTLoop
 
 # Configure logging
 logging.basicConfig(
@@ -38,23 +39,27 @@ class MQTTSubscriber:
         # Avoid client ID collision with publisher by default
         client_id = self.config.CLIENT_ID + (client_id_suffix or "")
         self._requested_topics: List[Tuple[str, int]] = self._normalize_topics(topics) if topics else []
-        self.client = mqtt.Client(client_id=client_id, clean_session=self.config.CLEAN_SESSION)
         self.is_connected = False
         self.message_count = 0
         self._external_handler = message_handler
 
-        # Set authentication if provided
-        if self.config.USERNAME and self.config.PASSWORD:
-            self.client.username_pw_set(self.config.USERNAME, self.config.PASSWORD)
-
-        # Configure callbacks
-        self.client.on_connect = self._on_connect
-        self.client.on_disconnect = self._on_disconnect
-        self.client.on_message = self._on_message
-        self.client.on_log = self._on_log
-
-        if self.config.AUTO_RECONNECT:
-            self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self._debug_callbacks = logger.isEnabledFor(logging.DEBUG)
+        # A reference on the shared client is only held while connected
+        self._loop = SharedMQTTLoop.get(self.config, client_id)
+        self._holding_loop = False
+        self.client = self._loop.client
+
+    def _callbacks(self) -> Dict[str, Callable]:
+        # Callbacks on the client shared with any publisher using the same ID; built per call
+        # rather than stored so an unconnected subscriber holds no reference cycle
+        callbacks = {
+            "on_connect": self._on_connect,
+            "on_disconnect": self._on_disconnect,
+            "on_message": self._on_message,
+        }
+        if self._debug_callbacks:
+            callbacks["on_log"] = self._on_log
+        return callbacks
 
     def _normalize_topics(self, topics: TopicList) -> List[Tuple[str, int]]:
         normalized: List[Tuple[str, int]] = []
@@ -86,7 +91,7 @@ class MQTTSubscriber:
     def _on_message(self, client, userdata, msg: mqtt.MQTTMessage):
         self.message_count += 1
         try:
-            logger.debug(f"Received message on {msg.topic}: {msg.payload}")
+            logger.debug("Received message on %s: %r", msg.topic, msg.payload)
             if self._external_handler:
                 self._external_handler(msg.topic, msg.payload)
         except Exception as exc:
@@ -98,13 +103,20 @@ class MQTTSubscriber:
     def connect(self) -> bool:
         try:
             logger.info(f"Connecting to MQTT broker at {self.config.BROKER_HOST}:{self.config.BROKER_PORT}")
-            self.client.connect(self.config.BROKER_HOST, self.config.BROKER_PORT, self.config.KEEPALIVE)
-            self.client.loop_start()
+            joined = False
+            if not self._holding_loop:
+                joined = not self._loop.acquire(**self._callbacks())
+                self._holding_loop = True
 
             timeout = 10
             start = time.time()
             while not self.is_connected and (time.time() - start) < timeout:
-                time.sleep(0.1)
+                self.is_connected = self.client.is_connected()
+                if not self.is_connected:
+                    time.sleep(0.1)
+            if joined and self.is_connected and self._requested_topics:
+                # A shared client that was already connected will not call our on_connect
+                self.subscribe(self._requested_topics)
             return self.is_connected
         except Exception as exc:
             logger.error(f"Failed to connect to MQTT broker: {exc}")
@@ -112,9 +124,10 @@ class MQTTSubscriber:
 
     def disconnect(self):
         try:
-            self.client.loop_stop()
-            self.client.disconnect()
+            if self._holding_loop:
+                self._loop.release(**self._callbacks())
         finally:
+            self._holding_loop = False
             self.is_connected = False
 
     def subscribe(self, topics: TopicList):
@@ -6,8 +6,7 @@ Run a subscriber that receives chunked files over MQTT and writes them to disk.
 import argparse
 import logging
 import signal
-import sys
-import time
+import threading
 
 from file_transfer import ChunkedFileSubscriber
 
@@ -20,13 +19,10 @@ def main():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
     receiver = ChunkedFileSubscriber(storage_dir=args.storage_dir)
+    stop_event = threading.Event()
 
     def handle_sigint(signum, frame):
-        print("\nStopping subscriber...")
-        try:
-            receiver.subscriber.disconnect()
-        finally:
-            sys.exit(0)
+        stop_event.set()
 
     signal.signal(signal.SIGINT, handle_sigint)
 
@@ -35,9 +31,10 @@ def main():
     print(f"Receiver running. Storage directory: {args.storage_dir}")
     print("Press Ctrl+C to stop.")
 
-    # Keep the process alive while MQTT network loop runs in background
-    while True:
-        time.sleep(1)
+    # MQTT network loop runs in a background thread; block here until Ctrl+C
+    stop_event.wait()
+    print("\nStopping subscriber...")
+    receiver.stop()
 
 
 if __name__ == "__main__":
@@ -11,7 +11,7 @@ from file_transfer import ChunkedFilePublisher
 def main():
     parser = argparse.ArgumentParser(description="Send a file over MQTT in chunks")
     parser.add_argument("path", help="Path to the file to send")
-    parser.add_argument("--chunk-size", type=int, default=256 * 1024, help="Chunk size in bytes (default 256KB)")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Chunk size in bytes (default: CHUNK_SIZE, or probed against the broker)")
     parser.add_argument("--qos", type=int, default=None, help="MQTT QoS level (0,1,2)")
     args = parser.parse_args()
 
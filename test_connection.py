@@ -3,29 +3,57 @@
 Test script to verify connection to an MQTT broker.
 """
 
+import os
+import json
 import time
+import zlib
+import struct
+import argparse
+import signal
+import socket
 import logging
-from mqtt_publisher import MQTTPublisher
+import threading
+from typing import Optional
+from mqtt_publisher import MQTTPublisher, MQTTPublisherPool
 from config import MQTTConfig
 
-# Configure logging
+# Configure logging: a raw epoch timestamp avoids strftime on every record. force=True
+# because importing mqtt_publisher has already configured the root logger.
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(created).3f - %(name)s - %(levelname)s - %(message)s',
+    force=True
 )
 logger = logging.getLogger(__name__)
+# QUIET=1 keeps only warnings and errors from this script
+if os.getenv('QUIET', '').lower() in ('1', 'true', 'yes'):
+    logger.setLevel(logging.WARNING)
 
-def test_mqtt_connection():
-    """Continuously publish test messages to verify broker connection"""
+# Interactive script that publishes until interrupted, not a test module for pytest
+__test__ = False
+
+# Log publish progress every N messages rather than every batch
+LOG_EVERY = 100
+
+BINARY_PAYLOAD = struct.Struct('<QQI')
+
+def test_mqtt_connection(stop: Optional[threading.Event] = None, binary: bool = False, pool: int = 0):
+    """Continuously publish test messages to verify broker connection (until stop is set).
+
+    With binary=True each payload is a packed (sequence, timestamp, broker crc32) struct
+    instead of JSON. With pool > 0, batches are spread round-robin over that many connections.
+    """
+    stop = stop or threading.Event()
     logger.info("Testing MQTT connection to configured broker...")
 
-    # Create publisher with default config
-    publisher = MQTTPublisher()
+    # Create publisher (or a pool of them) with default config
+    publisher = MQTTPublisherPool(pool) if pool > 0 else MQTTPublisher()
+    members = publisher.publishers if pool > 0 else [publisher]
 
     try:
         # Attempt to connect
-        logger.info(f"Connecting to {publisher.config.BROKER_HOST}:{publisher.config.BROKER_PORT}")
-        logger.info(f"Using credentials: {publisher.config.USERNAME}")
+        logger.info("Connecting to %s:%s", publisher.config.BROKER_HOST, publisher.config.BROKER_PORT)
+        logger.info("Using credentials: %s", publisher.config.USERNAME)
 
         if not publisher.connect():
             logger.error("❌ Failed to connect to MQTT broker")
@@ -33,34 +61,84 @@ def test_mqtt_connection():
 
         logger.info("✅ Successfully connected to MQTT broker!")
 
+        # Send each small PUBLISH immediately instead of letting Nagle hold it back,
+        # and give the kernel room to absorb a whole batch
+        for member in members:
+            sock = member.client.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+
         # Continuous publish loop
         test_topic = f"{publisher.config.TOPIC_PREFIX}/test/connection"
         interval = publisher.config.PUBLISH_INTERVAL
-        logger.info(f"Starting continuous publish every {interval}s to: {test_topic}")
+        logger.info("Starting continuous publish every %ss to: %s", interval, test_topic)
         logger.info("Press Ctrl+C to stop...")
 
+        # Publish in batches of PUBLISH_BATCH, one batch per interval * batch to keep the same average rate
+        batch_size = max(1, publisher.config.PUBLISH_BATCH)
+        # Constant across iterations: bind once instead of re-reading config per message
+        broker_str = f"{publisher.config.BROKER_HOST}:{publisher.config.BROKER_PORT}"
+        # Payload only varies in sequence and timestamp: splice them into prebuilt JSON bytes
+        # instead of building and json.dumps-ing a dict per message
+        payload_tmpl = (
+            b'{"message":"Connection test","sequence":%d,"timestamp":%d,"broker":'
+            + json.dumps(broker_str).replace("%", "%%").encode() + b'}'
+        )
+        # --binary: 20-byte little-endian (seq uint64, ts uint64, crc32(broker) uint32) payloads
+        pack = BINARY_PAYLOAD.pack
+        broker_hash = zlib.crc32(broker_str.encode()) & 0xffffffff
+        qos = publisher.config.QOS
+        publish_batch = publisher.publish_batch
+        log_info = logger.info
+        _time = time.time
+        _monotonic = time.monotonic
+        wait = stop.wait
+        # QoS 1/2 handles not yet acknowledged; publishing never blocks on them
+        pending = []
+        # Whole-second timestamp, re-read from the wall clock at most once per second
+        last_sec = int(_time())
+        next_refresh = _monotonic() + 1.0
+        # Pace against a monotonic deadline so publish time doesn't add drift to the interval
+        period = interval * batch_size
+        deadline = _monotonic()
         count = 0
-        while True:
-            count += 1
-            test_payload = {
-                "message": "Connection test",
-                "sequence": count,
-                "timestamp": int(time.time()),
-                "broker": f"{publisher.config.BROKER_HOST}:{publisher.config.BROKER_PORT}"
-            }
-
-            success = publisher.publish(test_topic, test_payload, publisher.config.QOS)
-            if success:
-                logger.info(f"✅ Published test message #{count}")
+        while not stop.is_set():
+            now_m = _monotonic()
+            if now_m >= next_refresh:
+                last_sec = int(_time())
+                next_refresh = now_m + 1.0
+            if binary:
+                batch = [pack(seq, last_sec, broker_hash) for seq in range(count + 1, count + batch_size + 1)]
+            else:
+                batch = [payload_tmpl % (seq, last_sec) for seq in range(count + 1, count + batch_size + 1)]
+            count += batch_size
+
+            infos = publish_batch(test_topic, batch, qos)
+            sent = len(infos)
+            if qos:
+                # Acks can complete out of order, so drop every acknowledged handle, not just a prefix
+                pending = [info for info in pending if not info.is_published()] + infos
+            if sent == len(batch):
+                if count // LOG_EVERY != (count - sent) // LOG_EVERY:
+                    log_info("✅ Published test messages up to #%d (%d awaiting ack)", count, len(pending))
             else:
-                logger.warning("⚠️ Test message publish failed (will retry)")
+                logger.warning("⚠️ Published %d/%d test messages (will retry)", sent, len(batch))
+
+            deadline += period
+            delay = deadline - _monotonic()
+            if delay > 0:
+                wait(delay)
+            elif delay < -period:
+                # More than a period behind (stall or suspend): resync instead of bursting to catch up
+                deadline = _monotonic()
 
-            time.sleep(interval)
+        logger.info("Interrupted by user. Stopping...")
 
     except KeyboardInterrupt:
         logger.info("Interrupted by user. Stopping...")
     except Exception as e:
-        logger.error(f"❌ Error during connection test: {e}")
+        logger.error("❌ Error during connection test: %s", e)
         return False
     finally:
         # Disconnect
@@ -73,10 +151,24 @@ def test_mqtt_connection():
     return True
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuously publish test messages to the configured MQTT broker")
+    parser.add_argument("--binary", action="store_true",
+                        help="Send packed 20-byte binary payloads instead of JSON")
+    parser.add_argument("--pool", type=int, nargs="?", const=4, default=0, metavar="N",
+                        help="Publish over a round-robin pool of N connections (default 4)")
+    args = parser.parse_args()
+
     logger.info("Starting MQTT connection test...")
     logger.info("=" * 50)
     
-    success = test_mqtt_connection()
+    # Ctrl+C sets the event, which wakes the publish loop's wait immediately
+    stop_event = threading.Event()
+
+    def handle_sigint(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_sigint)
+    success = test_mqtt_connection(stop_event, binary=args.binary, pool=args.pool)
     
     logger.info("=" * 50)
     if success:
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Test script for chunked file transfer
+
+These tests drive ChunkedFileSubscriber with hand-built messages; no MQTT
+broker connection is required.
+"""
+
+import os
+import hashlib
+import socket
+import threading
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import Mock, patch
+import paho.mqtt.client as mqtt
+import file_transfer
+from config import MQTTConfig
+from file_transfer import CHUNK_HEADER, PROBE_CHUNK_SIZES, ChunkedFilePublisher, ChunkedFileSubscriber, _missing_ranges, _remaining_length, _set_bit, decode_control, encode_control
+
+
+class TestMissingRanges(unittest.TestCase):
+    """Test cases for _missing_ranges"""
+
+    def _bitmap(self, received, total: int) -> bytearray:
+        bitmap = bytearray((total + 7) // 8)
+        for idx in received:
+            _set_bit(bitmap, idx)
+        return bitmap
+
+    def test_runs_within_and_across_words(self):
+        """Test gaps inside a word, spanning word boundaries and at the end are reported"""
+        total = 200
+        received = set(range(total)) - {0, 1, 2, 10} - set(range(60, 140)) - {199}
+        ranges = _missing_ranges(self._bitmap(received, total), total, 500)
+        self.assertEqual(ranges, [[0, 3], [10, 1], [60, 80], [199, 1]])
+
+    def test_complete_and_empty_bitmaps(self):
+        """Test a full bitmap has no gaps and an empty (or short) one is missing everything"""
+        self.assertEqual(_missing_ranges(self._bitmap(range(130), 130), 130, 500), [])
+        self.assertEqual(_missing_ranges(bytearray(), 130, 500), [[0, 130]])
+
+    def test_limit_caps_ranges(self):
+        """Test at most limit ranges are returned"""
+        total = 100
+        bitmap = self._bitmap(range(0, total, 2), total)
+        self.assertEqual(_missing_ranges(bitmap, total, 3), [[1, 1], [3, 1], [5, 1]])
+
+
+class TestRemainingLength(unittest.TestCase):
+    """Test cases for _remaining_length"""
+
+    def test_variable_byte_integer_boundaries(self):
+        """Test the encoding at each byte-count boundary of the MQTT variable byte integer"""
+        cases = {
+            0: b"\x00",
+            127: b"\x7f",
+            128: b"\x80\x01",
+            16383: b"\xff\x7f",
+            16384: b"\x80\x80\x01",
+            2097151: b"\xff\xff\x7f",
+            2097152: b"\x80\x80\x80\x01",
+            268435455: b"\xff\xff\xff\x7f",
+        }
+        for length, encoded in cases.items():
+            with self.subTest(length=length):
+                self.assertEqual(_remaining_length(length), encoded)
+
+
+class TestChunkedFileSubscriber(unittest.TestCase):
+    """Test cases for ChunkedFileSubscriber"""
+
+    file_id = "data.bin-600-test"
+
+    def setUp(self):
+        """Set up a subscriber writing into a temporary directory"""
+        self.config = MQTTConfig()
+        self.storage = tempfile.TemporaryDirectory()
+        self.addCleanup(self.storage.cleanup)
+        self.receiver = self._new_receiver()
+
+        self.data = os.urandom(600)
+        self.chunk_size = 256
+        self.chunks = [self.data[i:i + self.chunk_size] for i in range(0, len(self.data), self.chunk_size)]
+        self.meta = {
+            "file_id": self.file_id,
+            "name": "data.bin",
+            "size": len(self.data),
+            "chunk_size": self.chunk_size,
+            "total_chunks": len(self.chunks),
+        }
+        self.trailer = dict(
+            self.meta,
+            file_sha256=hashlib.sha256(self.data).hexdigest(),
+            chunk_sha256=[hashlib.sha256(c).digest() for c in self.chunks],
+        )
+
+    def _new_receiver(self) -> ChunkedFileSubscriber:
+        receiver = ChunkedFileSubscriber(storage_dir=self.storage.name, config=self.config)
+        receiver.subscriber.client = Mock()
+        self.addCleanup(receiver.stop)
+        return receiver
+
+    def _send(self, kind: str, payload: bytes, receiver: ChunkedFileSubscriber = None):
+        topic = f"{self.config.TOPIC_PREFIX}/file/{self.file_id}/{kind}"
+        (receiver or self.receiver)._on_message(topic, payload)
+
+    def _chunk(self, idx: int, data: bytes = None) -> bytes:
+        data = self.chunks[idx] if data is None else data
+        return CHUNK_HEADER.pack(idx, hashlib.sha256(data).digest()) + data
+
+    def _published(self, kind: str, receiver: ChunkedFileSubscriber = None) -> int:
+        client = (receiver or self.receiver).subscriber.client
+        return sum(1 for c in client.publish.call_args_list if c[0][0].endswith(f"/{kind}"))
+
+    def _last_published(self, kind: str, receiver: ChunkedFileSubscriber = None) -> dict:
+        client = (receiver or self.receiver).subscriber.client
+        payloads = [c[0][1] for c in client.publish.call_args_list if c[0][0].endswith(f"/{kind}")]
+        return decode_control(payloads[-1])
+
+    def _on_disk(self) -> bytes:
+        return (Path(self.storage.name) / self.file_id / "data.bin").read_bytes()
+
+    def test_corrupt_duplicate_does_not_overwrite_verified_chunk(self):
+        """Test a corrupt resend of an already verified chunk is ignored"""
+        self._send("meta", encode_control(self.meta))
+        self._send("chunk", self._chunk(0))
+        # Self-consistent header digest, so only the already-received check can reject it
+        self._send("chunk", self._chunk(0, b"\xff" * self.chunk_size))
+        for idx in range(1, len(self.chunks)):
+            self._send("chunk", self._chunk(idx))
+        self._send("meta", encode_control(self.trailer))
+
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertTrue(self.receiver._load_state(self.file_id)["complete"])
+        self.assertEqual(self._published("ack"), 1)
+
+
+    def test_out_of_order_and_duplicate_chunks_complete(self):
+        """Test chunks arriving out of order and twice still verify the file hash and ACK once"""
+        self._send("meta", encode_control(self.meta))
+        for idx in (2, 0, 2, 1, 0):
+            self._send("chunk", self._chunk(idx))
+        self.assertFalse(self.receiver._load_state(self.file_id)["complete"])
+        self.assertEqual(self._published("ack"), 0)
+
+        self._send("meta", encode_control(self.trailer))
+
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertTrue(self.receiver._load_state(self.file_id)["complete"])
+        self.assertEqual(self._published("ack"), 1)
+
+    def test_file_hash_mismatch_requests_every_chunk_again(self):
+        """Test a file hash mismatch withholds the ACK, asks for all chunks and accepts the resends"""
+        self._send("meta", encode_control(self.meta))
+        # Wrong at the source but self-consistent, so only the file hash can catch it
+        self._send("chunk", self._chunk(0, b"\xff" * self.chunk_size))
+        for idx in range(1, len(self.chunks)):
+            self._send("chunk", self._chunk(idx))
+        self._send("meta", encode_control(dict(self.trailer, chunk_sha256=None)))
+
+        self.assertFalse(self.receiver._load_state(self.file_id)["complete"])
+        self.assertEqual(self._published("ack"), 0)
+        self.assertEqual(self._last_published("retry")["missing_ranges"], [[0, len(self.chunks)]])
+        self.assertEqual(self.receiver._load_state(self.file_id)["received_count"], 0)
+        self.assertFalse(any((Path(self.storage.name) / self.file_id / "received.bits").read_bytes()))
+
+        for idx in range(len(self.chunks)):
+            self._send("chunk", self._chunk(idx))
+
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertEqual(self._published("ack"), 1)
+
+    def test_trailer_rejects_chunks_accepted_on_their_own_digest(self):
+        """Test chunks accepted before the trailer that do not match its hashes are requested again"""
+        self._send("meta", encode_control(self.meta))
+        self._send("chunk", self._chunk(0, b"\xff" * self.chunk_size))
+        for idx in range(1, len(self.chunks)):
+            self._send("chunk", self._chunk(idx))
+        self._send("meta", encode_control(self.trailer))
+
+        self.assertEqual(self._published("ack"), 0)
+        self.assertEqual(self._last_published("retry")["missing_ranges"], [[0, 1]])
+
+        self._send("chunk", self._chunk(0))
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertEqual(self._published("ack"), 1)
+
+    def test_trailer_checks_chunks_received_before_a_restart(self):
+        """Test chunks accepted before a restart are checked against the trailer from disk"""
+        self._send("meta", encode_control(self.meta))
+        self._send("chunk", self._chunk(1))
+        self._send("chunk", self._chunk(2, b"\xff" * len(self.chunks[2])))
+        self.receiver.stop()
+
+        receiver = self._new_receiver()
+        self._send("meta", encode_control(self.trailer), receiver)
+        self.assertEqual(self._last_published("retry", receiver)["missing_ranges"], [[0, 1], [2, 1]])
+
+        for idx in (0, 2):
+            self._send("chunk", self._chunk(idx), receiver)
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertEqual(self._published("ack", receiver), 1)
+
+    def test_out_of_range_chunk_indices_are_dropped(self):
+        """Test stray chunk indices never grow the bitmap or data file nor count towards completion"""
+        self._send("chunk", self._chunk(0))
+        self._send("chunk", CHUNK_HEADER.pack(2 ** 28, hashlib.sha256(b"x").digest()) + b"x")
+        state = self.receiver._load_state(self.file_id)
+        self.assertEqual((len(state["received"]), state["received_count"]), (0, 0))
+
+        self._send("meta", encode_control(self.meta))
+        self._send("chunk", self._chunk(len(self.chunks), self.chunks[0]))
+        self.assertEqual(state["received_count"], 0)
+        self.assertEqual(_missing_ranges(state["received"], len(self.chunks), 500), [[0, len(self.chunks)]])
+
+        for idx in range(len(self.chunks)):
+            self._send("chunk", self._chunk(idx))
+        self._send("meta", encode_control(self.trailer))
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertEqual(self._published("ack"), 1)
+
+    def test_resent_meta_after_ack_opens_no_files(self):
+        """Test a manifest re-sent after completion reports status without reopening the data file"""
+        self._send("meta", encode_control(self.meta))
+        for idx in range(len(self.chunks)):
+            self._send("chunk", self._chunk(idx))
+        self._send("meta", encode_control(self.trailer))
+        self.assertEqual(self.receiver._fd_cache, {})
+
+        self._send("meta", encode_control(self.trailer))
+
+        self.assertEqual(self.receiver._fd_cache, {})
+        self.assertEqual(self._published("ack"), 1)
+        self.assertEqual(self._on_disk(), self.data)
+
+    def test_state_survives_restart(self):
+        """Test a new receiver resumes the transfer after a clean stop"""
+        self._send("meta", encode_control(self.meta))
+        self._send("chunk", self._chunk(1))
+        self.receiver.stop()
+
+        receiver = self._new_receiver()
+        state = receiver._load_state(self.file_id)
+        self.assertEqual((state["name"], state["size"], state["total_chunks"]), ("data.bin", 600, 3))
+        self.assertEqual(state["received_count"], 1)
+        self.assertEqual(_missing_ranges(state["received"], 3, 500), [[0, 1], [2, 1]])
+
+        for idx in (0, 2):
+            self._send("chunk", self._chunk(idx), receiver)
+        self._send("meta", encode_control(self.trailer), receiver)
+
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertEqual(self._published("ack", receiver), 1)
+
+    def test_state_survives_crash_before_flush(self):
+        """Test the layout from the manifest is on disk before any chunk, so a crash loses nothing"""
+        self.config.STATE_FLUSH_INTERVAL_MS = 60000
+        self._send("meta", encode_control(self.meta))
+        self._send("chunk", self._chunk(1))
+
+        # No stop(): the process died with the flush timer still pending
+        receiver = self._new_receiver()
+        state = receiver._load_state(self.file_id)
+        self.assertEqual((state["name"], state["chunk_size"]), ("data.bin", self.chunk_size))
+
+        for idx in (0, 2):
+            self._send("chunk", self._chunk(idx), receiver)
+        self._send("meta", encode_control(self.trailer), receiver)
+
+        self.assertEqual(self._on_disk(), self.data)
+        self.assertEqual(self._published("ack", receiver), 1)
+        self.assertEqual(sorted(p.name for p in (Path(self.storage.name) / self.file_id).iterdir()),
+                         ["data.bin", "received.bits", "state.json"])
+
+class TestChunkedFilePublisher(unittest.TestCase):
+    """Test cases for ChunkedFilePublisher"""
+
+    def _loopback(self, data: bytes, chunk_size: int, hash_workers: int):
+        """Send data through send_file with every publish delivered straight to a receiver"""
+        storage = tempfile.TemporaryDirectory()
+        self.addCleanup(storage.cleanup)
+        config = MQTTConfig()
+        config.HASH_WORKERS = hash_workers
+        receiver = ChunkedFileSubscriber(storage_dir=storage.name, config=config)
+        receiver.subscriber.client = Mock()
+        self.addCleanup(receiver.stop)
+
+        def publish_bytes(topic, payload, qos):
+            receiver._on_message(topic, payload)
+            return Mock(rc=0)
+
+        source = Path(storage.name) / "source.bin"
+        source.write_bytes(data)
+        sender = ChunkedFilePublisher(publisher=Mock(is_connected=True, publish_bytes=publish_bytes), config=config)
+        file_id = sender.send_file(str(source), chunk_size=chunk_size, qos=1)
+
+        acks = [c for c in receiver.subscriber.client.publish.call_args_list if c[0][0].endswith("/ack")]
+        return (Path(storage.name) / file_id / "source.bin").read_bytes(), len(acks)
+
+    def test_send_chunks_loopback(self):
+        """Test files of many, one and no chunks arrive intact over both control codecs"""
+        cases = [
+            (os.urandom(100 * 1024 + 7), 1024, 3),  # chunks well past the 2 * HASH_WORKERS buffer ring
+            (os.urandom(10 * 1024), 1024, 1),
+            (os.urandom(500), 1024, 2),
+            (b"", 1024, 2),
+        ]
+        for cbor in (file_transfer.cbor2, None):
+            for data, chunk_size, hash_workers in cases:
+                with self.subTest(cbor=cbor is not None, size=len(data), hash_workers=hash_workers), \
+                        patch("file_transfer.cbor2", cbor):
+                    self.assertEqual(self._loopback(data, chunk_size, hash_workers), (data, 1))
+
+    def test_sendfile_refused_on_shared_client(self):
+        """Test the sendfile path never pauses a network thread other holders are using"""
+        config = MQTTConfig()
+        config.USE_SENDFILE = True
+        publisher = Mock(shares_client=True)
+        sender = ChunkedFilePublisher(publisher=publisher, config=config)
+
+        self.assertIsNone(sender._sendfile_socket(0))
+        publisher.client.socket.assert_not_called()
+
+    def _probe(self, rtts, file_size=10 * 1024 * 1024):
+        """Run the chunk size probe against a fake broker taking rtts[size] seconds to PUBACK (None: never)"""
+        clock = [0.0]
+        publisher = Mock(is_connected=True)
+
+        def publish_bytes(topic, payload, qos):
+            rtt = rtts[len(payload)]
+            info = Mock()
+            info.wait_for_publish.side_effect = lambda timeout: clock.__setitem__(0, clock[0] + (rtt or timeout))
+            info.is_published.return_value = rtt is not None
+            return info
+
+        publisher.publish_bytes.side_effect = publish_bytes
+        sender = ChunkedFilePublisher(publisher=publisher, config=MQTTConfig())
+        with patch("file_transfer.time.monotonic", lambda: clock[0]):
+            return sender, sender._probe_chunk_size(file_size)
+
+    def test_probe_picks_throughput_knee(self):
+        """Test the probe stops at the size past which throughput barely improves"""
+        small, medium, large = PROBE_CHUNK_SIZES
+        sender, chunk_size = self._probe({small: 0.050, medium: 0.060, large: 0.200})
+        self.assertEqual(chunk_size, medium)
+        topics = {c[0][0] for c in sender.publisher.publish_bytes.call_args_list}
+        self.assertEqual(topics, {f"{sender.config.TOPIC_PREFIX}/probe/chunk"})
+
+        # Cached for later transfers
+        self.assertEqual(sender._probe_chunk_size(10 * 1024 * 1024), medium)
+        self.assertEqual(sender.publisher.publish_bytes.call_count, 3)
+
+    def test_probe_stops_at_unacknowledged_size(self):
+        """Test a size the broker never acknowledges is not picked"""
+        small, medium, large = PROBE_CHUNK_SIZES
+        _, chunk_size = self._probe({small: 0.050, medium: 0.050, large: None})
+        self.assertEqual(chunk_size, medium)
+
+    def test_probe_skipped_for_small_files(self):
+        """Test files that fit in the smallest candidate are sent without probing"""
+        sender, chunk_size = self._probe({}, file_size=1000)
+        self.assertEqual(chunk_size, PROBE_CHUNK_SIZES[0])
+        sender.publisher.publish_bytes.assert_not_called()
+
+    def test_sendfile_frames(self):
+        """Test the sendfile path writes well-formed QoS 0 PUBLISH frames with header and body intact"""
+        data = os.urandom(10 * 1024 + 3)
+        chunk_size, topic = 4096, "orca/iot/file/f/chunk"
+        total = (len(data) + chunk_size - 1) // chunk_size
+        client = Mock(_protocol=mqtt.MQTTv311)
+        client.want_write.return_value = False
+        sender = ChunkedFilePublisher(publisher=Mock(client=client), config=MQTTConfig())
+
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        received = bytearray()
+        reader = threading.Thread(target=lambda: [received.extend(b) for b in iter(lambda: theirs.recv(65536), b"")])
+        reader.start()
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            hashes = sender._send_chunks_sendfile(ours, f, topic, chunk_size, total, hashlib.sha256())
+        ours.shutdown(socket.SHUT_WR)
+        reader.join(5)
+
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        self.assertEqual(hashes, [hashlib.sha256(c).digest() for c in chunks])
+        pos = 0
+        for idx, chunk in enumerate(chunks):
+            self.assertEqual(received[pos], 0x30)  # PUBLISH, QoS 0, no DUP/RETAIN
+            pos += 1
+            remaining, shift = 0, 0
+            while True:
+                byte = received[pos]
+                pos += 1
+                remaining |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            frame = bytes(received[pos:pos + remaining])
+            pos += remaining
+            topic_len = int.from_bytes(frame[:2], "big")
+            self.assertEqual(frame[2:2 + topic_len].decode(), topic)
+            payload = frame[2 + topic_len:]
+            self.assertEqual(CHUNK_HEADER.unpack_from(payload), (idx, hashes[idx]))
+            self.assertEqual(payload[CHUNK_HEADER.size:], chunk)
+        self.assertEqual(pos, len(received))
+        client.loop_stop.assert_called_once()
+        client.loop_start.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
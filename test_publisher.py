@@ -6,18 +6,38 @@ This script tests the MQTT publisher functionality without requiring
 an actual MQTT broker connection.
 """
 
+import gc
+import copy
+import io
+import sys
+import json
+import subprocess
 import unittest
 from unittest.mock import Mock, patch
-from mqtt_publisher import MQTTPublisher
+from mqtt_publisher import MQTTPublisher, MQTTPublisherPool
+from mqtt_loop import SharedMQTTLoop
 from config import MQTTConfig
 
 class TestMQTTPublisher(unittest.TestCase):
     """Test cases for MQTTPublisher class"""
     
+    @classmethod
+    def setUpClass(cls):
+        """Build the config once; tests only read it (copy.copy it before mutating)"""
+        cls._base_config = MQTTConfig()
+        # No test talks to a broker: skip paho's socket pair and lock setup per client
+        cls._paho_patch = patch('mqtt_loop.mqtt.Client')
+        cls._paho_mock = cls._paho_patch.start()
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls._paho_patch.stop()
+    
     def setUp(self):
         """Set up test fixtures"""
-        self.config = MQTTConfig()
+        self.config = self._base_config
         self.publisher = MQTTPublisher(self.config)
+        self.addCleanup(self.publisher.disconnect)
     
     def test_config_defaults(self):
         """Test configuration default values"""
@@ -90,37 +110,188 @@ class TestMQTTPublisher(unittest.TestCase):
             topic = call_args[0][0]
             self.assertEqual(topic, f"{self.config.TOPIC_PREFIX}/alerts/{alert_type}")
     
+    def test_publish_json(self):
+        """Test publishing a dict through the JSON fast path"""
+        self.publisher.is_connected = True
+        with patch.object(self.publisher.client, 'publish') as mock_publish:
+            mock_publish.return_value = Mock(rc=0)
+            
+            result = self.publisher.publish_json("test/topic", {"value": 1}, qos=0)
+            
+            self.assertTrue(result)
+            mock_publish.assert_called_once()
+            topic, payload, qos = mock_publish.call_args[0]
+            self.assertEqual((topic, json.loads(payload), qos), ("test/topic", {"value": 1}, 0))
+            self.assertEqual(self.publisher.message_count, 1)
+    
+    def test_publish_bytes(self):
+        """Test publishing raw bytes returns the paho message info"""
+        with patch.object(self.publisher.client, 'publish') as mock_publish:
+            info = Mock(rc=0)
+            mock_publish.return_value = info
+            
+            result = self.publisher.publish_bytes("test/topic", b"\x00\x01")
+            
+            self.assertIs(result, info)
+            mock_publish.assert_called_once_with("test/topic", b"\x00\x01", self.config.QOS)
+            self.assertEqual(self.publisher.message_count, 1)
+
+    def test_publish_batch(self):
+        """Test publishing a batch of payloads to one topic"""
+        with patch.object(self.publisher.client, 'publish') as mock_publish:
+            mock_publish.return_value = Mock(rc=0)
+            self.publisher.is_connected = True
+
+            infos = self.publisher.publish_batch("test/topic", [{"seq": 1}, "raw"])
+
+            self.assertEqual(infos, [mock_publish.return_value] * 2)
+            self.assertEqual(mock_publish.call_count, 2)
+            mock_publish.assert_called_with("test/topic", "raw", self.config.QOS)
+            self.assertEqual(self.publisher.message_count, 2)
+
+    def test_publisher_pool_round_robin(self):
+        """Test the pool gives each member its own client ID and rotates publishes"""
+        pool = MQTTPublisherPool(2, self.config)
+        self.addCleanup(pool.disconnect)
+        self.assertEqual([p.config.CLIENT_ID for p in pool.publishers],
+                         ['orca_iot_publisher_0', 'orca_iot_publisher_1'])
+        self.assertEqual(self.config.CLIENT_ID, 'orca_iot_publisher')
+
+        with patch.object(pool.publishers[0], 'publish', return_value=True) as first, \
+                patch.object(pool.publishers[1], 'publish', return_value=True) as second:
+            for _ in range(3):
+                self.assertTrue(pool.publish("test/topic", "x"))
+            self.assertEqual((first.call_count, second.call_count), (2, 1))
+
     def test_get_stats(self):
         """Test getting publisher statistics"""
         stats = self.publisher.get_stats()
         
-        expected_keys = ['connected', 'message_count', 'broker_host', 'broker_port', 'client_id']
-        for key in expected_keys:
-            self.assertIn(key, stats)
+        expected = {
+            'connected': False,
+            'message_count': 0,
+            'broker_host': 'localhost',
+            'broker_port': 1883,
+            'client_id': 'orca_iot_publisher',
+        }
+        self.assertGreaterEqual(stats.keys(), expected.keys())
+        self.assertEqual({k: stats[k] for k in expected}, expected)
+
+class TestSharedMQTTLoop(unittest.TestCase):
+    """Test cases for sharing one paho client between holders with the same client ID"""
+    
+    def setUp(self):
+        """Patch paho's Client with a mock whose callbacks start unset, like a real client"""
+        self.config = MQTTConfig()
+        self.config.CLIENT_ID = 'shared_loop_test'
+        client = Mock(on_connect=None, on_disconnect=None, on_message=None, on_publish=None, on_log=None)
+        client.is_connected.return_value = True
+        paho_patch = patch('mqtt_loop.mqtt.Client', return_value=client)
+        paho_patch.start()
+        self.addCleanup(paho_patch.stop)
+    
+    def _publisher(self) -> MQTTPublisher:
+        publisher = MQTTPublisher(self.config)
+        self.addCleanup(publisher.disconnect)
+        return publisher
+    
+    def test_same_client_id_shares_one_client(self):
+        """Test holders share one client and only the first connect opens it"""
+        first, second = self._publisher(), self._publisher()
+        self.assertIs(first.client, second.client)
+        
+        self.assertTrue(first.connect())
+        self.assertFalse(first.shares_client)
+        self.assertTrue(second.connect())
+        self.assertTrue(first.shares_client)
+        first.client.connect.assert_called_once()
+        first.client.loop_start.assert_called_once()
+    
+    def test_release_closes_on_last_holder(self):
+        """Test the connection stays up until every holder has disconnected"""
+        first, second = self._publisher(), self._publisher()
+        first.connect()
+        second.connect()
+        client = first.client
+        
+        first.disconnect()
+        first.disconnect()  # a second disconnect must not drop another holder's reference
+        client.loop_stop.assert_not_called()
+        self.assertFalse(second.shares_client)
+        
+        second.disconnect()
+        client.loop_stop.assert_called_once()
+        client.disconnect.assert_called_once()
+    
+    def test_callbacks_fan_out_to_connected_holders(self):
+        """Test paho callbacks reach every connected holder and stop after release"""
+        first, second = self._publisher(), self._publisher()
+        first.connect()
+        second.connect()
+        
+        first.disconnect()
+        second.client.on_disconnect(second.client, None, 1)
+        self.assertFalse(second.is_connected)
+        
+        second.client.on_connect(second.client, None, {}, 0)
+        self.assertTrue(second.is_connected)
+        self.assertFalse(first.is_connected)
+    
+    def test_different_settings_for_shared_client_rejected(self):
+        """Test a second holder cannot silently inherit another holder's credentials"""
+        first = self._publisher()
+        other = copy.copy(self.config)
+        other.USERNAME, other.PASSWORD = 'someone', 'else'
+        with self.assertRaises(ValueError):
+            MQTTPublisher(other)
+        self.assertIs(self._publisher().client, first.client)
+    
+    def test_unconnected_holder_leaves_no_registry_entry(self):
+        """Test a publisher dropped without connecting does not keep its client registered"""
+        publisher = MQTTPublisher(self.config)
+        key = (self.config.BROKER_HOST, self.config.BROKER_PORT, self.config.CLIENT_ID)
+        self.assertIn(key, SharedMQTTLoop._registry)
         
-        self.assertEqual(stats['connected'], False)
-        self.assertEqual(stats['message_count'], 0)
-        self.assertEqual(stats['broker_host'], 'localhost')
-        self.assertEqual(stats['broker_port'], 1883)
-        self.assertEqual(stats['client_id'], 'orca_iot_publisher')
+        del publisher
+        gc.collect()
+        self.assertNotIn(key, SharedMQTTLoop._registry)
+
+# Test cases loaded on the first run_tests() call; they keep no state between runs
+_SUITE = None
 
 def run_tests():
     """Run the test suite"""
+    try:
+        import pytest  # noqa: F401
+        import xdist  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        # The tests share no state, so let pytest-xdist spread them across all cores
+        return subprocess.call([sys.executable, "-m", "pytest", "-n", "auto", __file__]) == 0
+    
     print("Running MQTT Publisher Tests...")
     print("=" * 40)
     
-    # Create test suite
-    suite = unittest.TestLoader().loadTestsFromTestCase(TestMQTTPublisher)
+    # Load the test cases once; reruns (e.g. from a watch loop) reuse them. A running
+    # TestSuite drops each test after it runs, so wrap them in a fresh suite every time.
+    global _SUITE
+    _SUITE = _SUITE or tuple(test for case in (TestMQTTPublisher, TestSharedMQTTLoop)
+                            for test in unittest.TestLoader().loadTestsFromTestCase(case))
+    suite = unittest.TestSuite(_SUITE)
     
-    # Run tests
-    runner = unittest.TextTestRunner(verbosity=2)
+    # Run tests, capturing the runner's per-test output; only the summary is printed
+    stream = io.StringIO()
+    runner = unittest.TextTestRunner(verbosity=1, stream=stream)
     result = runner.run(suite)
     
     # Print summary
-    print("\n" + "=" * 40)
+    print(f"Ran {result.testsRun} tests: {len(result.failures)} failures, {len(result.errors)} errors")
+    print("=" * 40)
     if result.wasSuccessful():
         print("✅ All tests passed!")
     else:
+        print(stream.getvalue())
         print("❌ Some tests failed!")
     
     return result.wasSuccessful()